@@ -2,11 +2,21 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import os
-from typing import List, Optional
+import json
+import time
+import uuid
+import asyncio
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
 import voyageai
-from qdrant_client import QdrantClient
+import blake3
+import diskcache
+import numpy as np
+from cachetools import TTLCache
+from qdrant_client import AsyncQdrantClient, models
 import logging
 from dotenv import load_dotenv
+from semantic_ats import EMBED_BACKEND, VOYAGE_EMBED_MODEL, LOCAL_EMBED_MODEL, LOCAL_COLLECTION_SUFFIX, LocalEmbedder
 
 load_dotenv()
 
@@ -18,12 +28,40 @@ logger = logging.getLogger(__name__)
 voyageai.api_key=os.getenv("VOYAGE_API_KEY")
 voyage_client = voyageai.Client()
 
+# Story/personality queries use the same backend, read by semantic_ats, that indexed them
+local_embedder = LocalEmbedder() if EMBED_BACKEND == "local" else None
+
 # Initialize Qdrant client
-qdrant_client = QdrantClient(
+qdrant_client = AsyncQdrantClient(
     url=os.getenv('QDRANT_URL'),
     api_key=os.getenv('QDRANT_API_KEY')
 )
 
+# Semantic query cache settings
+QUERY_CACHE_COLLECTION = "query_cache"
+QUERY_CACHE_THRESHOLD = float(os.getenv("QUERY_CACHE_THRESHOLD", "0.95"))
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "86400"))  # seconds
+QUERY_CACHE_SWEEP_INTERVAL = int(os.getenv("QUERY_CACHE_SWEEP_INTERVAL", "3600"))  # seconds
+
+# HNSW beam width for /search; raise for recall, lower for latency
+SEARCH_HNSW_EF = int(os.getenv("SEARCH_HNSW_EF", "128"))
+
+# Payload keys each search mode returns
+MODE_PAYLOAD_FIELDS = {
+    "resume": ["filename", "story", "personality", "raw_text"],
+    "story": ["filename", "story"],
+    "personality": ["filename", "personality"],
+}
+
+# In-process exact-match caches, checked before any network call
+_emb_cache: TTLCache = TTLCache(maxsize=10_000, ttl=3600)  # (model, normalized query) -> embedding
+_resp_cache: TTLCache = TTLCache(maxsize=2_000, ttl=600)  # (mode, normalized query) -> SearchResponse
+_emb_locks: Dict[Tuple[str, str], asyncio.Lock] = defaultdict(asyncio.Lock)
+
+# Persistent query embedding cache behind the in-process one
+QUERY_EMBEDDING_DISK_TTL = 86400 * 30  # seconds
+_emb_disk_cache = diskcache.Cache("data/query_emb_cache", size_limit=2**30)
+
 app = FastAPI()
 
 # Add CORS middleware
@@ -55,6 +93,174 @@ class SearchResult(BaseModel):
 class SearchResponse(BaseModel):
     results: List[SearchResult]
 
+async def _initialize_query_cache():
+    """Create the query cache collection if it doesn't exist"""
+    existing_collections = (await qdrant_client.get_collections()).collections
+    if QUERY_CACHE_COLLECTION in [c.name for c in existing_collections]:
+        logger.info(f"Collection already exists: {QUERY_CACHE_COLLECTION}")
+        return
+
+    await qdrant_client.create_collection(
+        collection_name=QUERY_CACHE_COLLECTION,
+        vectors_config=models.VectorParams(
+            size=1024,
+            distance=models.Distance.COSINE,
+            datatype=models.Datatype.FLOAT16
+        )
+    )
+    # Index the fields we filter on so lookups and sweeps stay cheap
+    await qdrant_client.create_payload_index(
+        collection_name=QUERY_CACHE_COLLECTION,
+        field_name="mode",
+        field_schema=models.PayloadSchemaType.KEYWORD
+    )
+    await qdrant_client.create_payload_index(
+        collection_name=QUERY_CACHE_COLLECTION,
+        field_name="model",
+        field_schema=models.PayloadSchemaType.KEYWORD
+    )
+    await qdrant_client.create_payload_index(
+        collection_name=QUERY_CACHE_COLLECTION,
+        field_name="ts",
+        field_schema=models.PayloadSchemaType.FLOAT
+    )
+    logger.info(f"Created collection: {QUERY_CACHE_COLLECTION}")
+
+async def _sweep_query_cache():
+    """Periodically drop cached responses older than the TTL"""
+    while True:
+        await asyncio.sleep(QUERY_CACHE_SWEEP_INTERVAL)
+        try:
+            await qdrant_client.delete(
+                collection_name=QUERY_CACHE_COLLECTION,
+                points_selector=models.FilterSelector(
+                    filter=models.Filter(
+                        must=[
+                            models.FieldCondition(
+                                key="ts",
+                                range=models.Range(lt=time.time() - QUERY_CACHE_TTL)
+                            )
+                        ]
+                    )
+                )
+            )
+            logger.info("Swept expired entries from query cache")
+        except Exception as e:
+            logger.error(f"Query cache sweep error: {str(e)}")
+
+@app.on_event("startup")
+async def startup():
+    try:
+        await _initialize_query_cache()
+    except Exception as e:
+        # Search still works without the cache
+        logger.error(f"Query cache initialization error: {str(e)}")
+    app.state.cache_sweeper = asyncio.create_task(_sweep_query_cache())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.cache_sweeper.cancel()
+    await qdrant_client.close()
+    _emb_disk_cache.close()
+
+async def _lookup_query_cache(query_embedding: List[float], mode: str, model: str) -> Optional[SearchResponse]:
+    """Return a cached response for a semantically equivalent query, if any"""
+    try:
+        hits = (await qdrant_client.query_points(
+            collection_name=QUERY_CACHE_COLLECTION,
+            query=query_embedding,
+            query_filter=models.Filter(
+                must=[
+                    models.FieldCondition(key="mode", match=models.MatchValue(value=mode)),
+                    # Vectors from different models aren't comparable
+                    models.FieldCondition(key="model", match=models.MatchValue(value=model)),
+                    models.FieldCondition(key="ts", range=models.Range(gte=time.time() - QUERY_CACHE_TTL))
+                ]
+            ),
+            limit=1
+        )).points
+        if hits and hits[0].score >= QUERY_CACHE_THRESHOLD:
+            return SearchResponse(**json.loads(hits[0].payload["response"]))
+    except Exception as e:
+        # A broken or missing cache falls through to the live search
+        logger.error(f"Query cache lookup error: {str(e)}")
+    return None
+
+async def _store_query_cache(query_embedding: List[float], mode: str, model: str, response: SearchResponse) -> None:
+    """Write a search response back to the query cache"""
+    try:
+        await qdrant_client.upsert(
+            collection_name=QUERY_CACHE_COLLECTION,
+            points=[
+                models.PointStruct(
+                    id=uuid.uuid4().hex,
+                    vector=query_embedding,
+                    payload={
+                        "mode": mode,
+                        "model": model,
+                        "response": response.model_dump_json(),
+                        "ts": time.time()
+                    }
+                )
+            ]
+        )
+    except Exception as e:
+        # A failed cache write shouldn't fail the search itself
+        logger.error(f"Query cache write error: {str(e)}")
+
+def _normalize_query(text: str) -> str:
+    """Normalize a query string for exact-match cache keys"""
+    return text.strip().lower()
+
+def _query_model(mode: str) -> str:
+    """Embedding model whose vectors the collection searched in this mode holds"""
+    # Full_Texts is built with Voyage regardless of the processing backend
+    if local_embedder is not None and mode != "resume":
+        return LOCAL_EMBED_MODEL
+    return VOYAGE_EMBED_MODEL
+
+async def _embed_query(text: str, normalized: str, model: str) -> List[float]:
+    """Embed a search query, reusing recent embeddings for identical queries"""
+    key = (model, normalized)
+    embedding = _emb_cache.get(key)
+    if embedding is not None:
+        return embedding
+
+    # Only one request per query string pays for the embedding call
+    lock = _emb_locks[key]
+    async with lock:
+        try:
+            embedding = _emb_cache.get(key)
+            if embedding is None:
+                # Embeddings persisted by earlier runs survive restarts
+                disk_key = blake3.blake3(f"{model}\n{normalized}".encode()).digest()
+                stored = _emb_disk_cache.get(disk_key)
+                if stored is not None:
+                    embedding = np.frombuffer(stored, dtype=np.float16).astype(np.float32).tolist()
+                else:
+                    # The normalized form is only a cache key; embed what the user typed
+                    if model == VOYAGE_EMBED_MODEL:
+                        embedding = (await asyncio.to_thread(
+                            voyage_client.embed,
+                            texts=[text],
+                            model=VOYAGE_EMBED_MODEL,
+                            input_type="query"
+                        )).embeddings[0]
+                    else:
+                        embedding = (await asyncio.to_thread(local_embedder.embed_query, text)).tolist()
+                    # Stored at half precision to halve the disk footprint
+                    _emb_disk_cache.set(
+                        disk_key,
+                        np.asarray(embedding, dtype=np.float16).tobytes(),
+                        expire=QUERY_EMBEDDING_DISK_TTL
+                    )
+                _emb_cache[key] = embedding
+        finally:
+            # Only the holder retires the entry, and only while it is still this lock
+            if _emb_locks.get(key) is lock:
+                del _emb_locks[key]
+    return embedding
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
@@ -66,41 +272,79 @@ async def search_resumes(query: SearchQuery) -> SearchResponse:
     try:
         logger.info(f"Searching with query: {query.query} in mode: {query.mode}")
         
+        normalized = _normalize_query(query.query)
+        cache_key: Tuple[str, str] = (query.mode, normalized)
+
+        # Identical queries are answered from memory
+        cached = _resp_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Response cache hit, returning {len(cached.results)} results")
+            return cached
+
         # Generate embedding for the search query
-        query_embedding = voyage_client.embed(
-            texts=[query.query],
-            model="voyage-3",
-            input_type="query"
-        ).embeddings[0]
+        model = _query_model(query.mode)
+        query_embedding = await _embed_query(query.query, normalized, model)
+
+        # Serve paraphrases of earlier queries straight from the cache
+        cached = await _lookup_query_cache(query_embedding, query.mode, model)
+        if cached is not None:
+            logger.info(f"Query cache hit, returning {len(cached.results)} results")
+            _resp_cache[cache_key] = cached
+            return cached
         
         # Here's where the magic happens - determine collection based on mode
         if query.mode == "resume":
             collection = "Full_Texts"  # Your new collection
         else:
             collection = "storyteller" if query.mode == "story" else "personality"
+            # Locally embedded vectors live in their own collections
+            if local_embedder is not None:
+                collection += LOCAL_COLLECTION_SUFFIX
         
         # Search in Qdrant
-        search_results = qdrant_client.search(
+        search_results = (await qdrant_client.query_points(
             collection_name=collection,
-            query_vector=query_embedding,
-            limit=10
-        )
+            query=query_embedding,
+            limit=10,
+            # Only pull the payload keys this mode returns; raw_text is large
+            with_payload=MODE_PAYLOAD_FIELDS.get(query.mode, ["filename"]),
+            # Search the INT8 vectors, then rescore the top candidates at full precision
+            search_params=models.SearchParams(
+                hnsw_ef=SEARCH_HNSW_EF,
+                quantization=models.QuantizationSearchParams(
+                    rescore=True,
+                    oversampling=2.0
+                )
+            )
+        )).points
         
-        # Format results with a twist
-        results = []
-        for hit in search_results:
-            result = SearchResult(
+        # Format results with a twist - pick the fields for this mode once, not per hit
+        match query.mode:
+            case "resume":
+                project = lambda p: (p.get("story"), p.get("personality"), p.get("raw_text"))
+            case "story":
+                project = lambda p: (p.get("story"), None, None)
+            case "personality":
+                project = lambda p: (None, p.get("personality"), None)
+            case _:
+                project = lambda p: (None, None, None)
+
+        results = [
+            SearchResult(
                 filename=hit.payload["filename"],
                 score=hit.score,
-                # Now we're getting fancy - conditionally add fields based on mode
-                story=hit.payload.get("story") if query.mode in ["story", "resume"] else None,
-                personality=hit.payload.get("personality") if query.mode in ["personality", "resume"] else None,
-                rawText=hit.payload.get("raw_text") if query.mode == "resume" else None
+                story=(fields := project(hit.payload))[0],
+                personality=fields[1],
+                rawText=fields[2]
             )
-            results.append(result)
+            for hit in search_results
+        ]
         
         logger.info(f"Found {len(results)} results")
-        return SearchResponse(results=results)
+        response = SearchResponse(results=results)
+        _resp_cache[cache_key] = response
+        await _store_query_cache(query_embedding, query.mode, model, response)
+        return response
     
     except Exception as e:
         logger.error(f"Search error: {str(e)}")
@@ -1,20 +1,46 @@
 import os
-import json
+import aiofiles
+import blake3
+import diskcache
 import uuid
 import logging
+import random
 import asyncio
+import threading
 import voyageai
-from qdrant_client import QdrantClient, models
+from voyageai.error import RateLimitError
+from qdrant_client import AsyncQdrantClient, models
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Optional, Union, Tuple, Callable, Awaitable
 import anthropic
+import httpx
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Resume files processed at once; each one makes two concurrent LLM calls.
+# Each file also queues two texts for embedding, so ingestion batches top out
+# at 2 * MAX_CONCURRENT_FILES = 40 texts, below Voyage's 128-text limit.
+MAX_CONCURRENT_FILES = 20
+
+# Embedding models; EMBED_BACKEND=local swaps Voyage for a local GPU model
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "voyage").strip().lower()
+VOYAGE_EMBED_MODEL = "voyage-3"
+LOCAL_EMBED_MODEL = "BAAI/bge-large-en-v1.5"
+LOCAL_EMBED_DEVICE = os.getenv("LOCAL_EMBED_DEVICE", "cuda")
+LOCAL_COLLECTION_SUFFIX = "_local"
+# BGE expects this instruction on queries (not documents) for retrieval
+BGE_QUERY_INSTRUCTION = "Represent this sentence for searching relevant passages: "
+
+# Qdrant bulk upload settings
+UPLOAD_BATCH_SIZE = 256
+UPLOAD_PARALLEL = 4
+
 def setup_logging():
     """Configure logging settings"""
     log_dir = Path("logs")
@@ -35,13 +61,16 @@ def setup_logging():
 
 class LLMProcessor:
     """Base class for LLM processing"""
-    def __init__(self):
-        self.client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None):
+        self.client = anthropic.AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            http_client=http_client
+        )
     
     async def process(self, text: str, prompt_template: str) -> str:
         """Process text using the LLM"""
         try:
-            message = self.client.messages.create(
+            message = await self.client.messages.create(
                 model="claude-3-5-sonnet-20241022",
                 max_tokens=1024,
                 temperature=1,
@@ -57,96 +86,360 @@ class LLMProcessor:
             logging.error(f"Error in LLM processing: {str(e)}")
             raise
 
+class BatchingEmbedder:
+    """Coalesces single-text embedding requests from concurrent callers into full batches"""
+    def __init__(self, embed_batch: Callable[[List[str]], Awaitable[np.ndarray]],
+                 max_batch_size: int = 128, max_wait_ms: int = 25, max_concurrency: int = 5):
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._flushes: set = set()
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Queue a text and wait for its embedding"""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def close(self) -> None:
+        """Stop the queue worker once in-flight batches have finished"""
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    async def _run(self) -> None:
+        """Drain the queue into batches of up to max_batch_size, waiting at most max_wait"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Keep draining while this batch is in flight
+            flush = asyncio.create_task(self._flush(batch))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        """Embed one batch and hand each caller its vector"""
+        async with self.semaphore:
+            try:
+                embeddings = await self.embed_batch([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+class LocalEmbedder:
+    """Embedding generation with a local sentence-transformers model on the GPU"""
+    def __init__(self, model_name: str = LOCAL_EMBED_MODEL, device: str = LOCAL_EMBED_DEVICE):
+        # Optional dependency, only needed when EMBED_BACKEND=local
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device=device)
+        if device.startswith("cuda"):
+            self.model.half()
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self._lock = threading.Lock()  # One encode at a time on the GPU
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """Generate normalized embeddings for multiple texts"""
+        with self._lock:
+            embeddings = self.model.encode(
+                texts,
+                batch_size=64,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+        return embeddings.astype(np.float32)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Generate a normalized embedding for a search query"""
+        return self.embed_batch([BGE_QUERY_INSTRUCTION + text])[0]
+
 class EmbeddingModel:
-    """Base class for embedding generation using Voyage AI"""
-    def __init__(self):
-        self.client = voyageai.Client(
-            api_key=os.getenv("VOYAGE_API_KEY")
+    """Base class for embedding generation using Voyage AI or a local model"""
+    def __init__(self, max_concurrency: int = 5, max_retries: int = 5):
+        self.backend = EMBED_BACKEND
+        if self.backend == "local":
+            self.local = LocalEmbedder()
+            self.model_name = LOCAL_EMBED_MODEL
+            self.dimension = self.local.dimension
+            # Local vectors live apart from the Voyage ones
+            self.collection_suffix = LOCAL_COLLECTION_SUFFIX
+        else:
+            self.client = voyageai.Client(
+                api_key=os.getenv("VOYAGE_API_KEY")
+            )
+            self.model_name = VOYAGE_EMBED_MODEL
+            self.dimension = 1024
+            self.collection_suffix = ""
+        self.batch_size = 128  # Texts per embedding call; Voyage's maximum batch size
+        self.max_concurrency = max_concurrency  # Batches in flight at once
+        self.max_retries = max_retries
+        self.batcher = BatchingEmbedder(
+            self.embed_batch,
+            max_batch_size=self.batch_size,
+            max_concurrency=max_concurrency
         )
-        self.batch_size = 128  # Voyage's maximum batch size
-    
-    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
-        """Generate embeddings for multiple texts using Voyage AI"""
+
+    def _sync_embed(self, texts: List[str]) -> np.ndarray:
+        """Blocking embedding call, run off the event loop"""
+        if self.backend == "local":
+            return self.local.embed_batch(texts)
+
+        response = self.client.embed(
+            texts=texts,
+            model=VOYAGE_EMBED_MODEL,
+            input_type="document",
+            output_dimension=self.dimension
+        )
+        # One contiguous float32 matrix instead of lists of Python floats
+        return np.asarray(response.embeddings, dtype=np.float32)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """Honor Retry-After when Voyage sends it, otherwise back off exponentially with jitter"""
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("Retry-After") or headers.get("retry-after")
         try:
-            response = self.client.embed(
-                texts=texts,
-                model="voyage-3",
-                input_type="document",
-                output_dimension=1024
-            )
-            return response.embeddings
-            
-        except Exception as e:
-            logging.error(f"Error in Voyage AI batch embedding generation: {str(e)}")
-            raise
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = 2 ** attempt
+        return delay + random.uniform(0, 1)
+
+    async def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """Generate embeddings for multiple texts with the configured backend"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await asyncio.to_thread(self._sync_embed, texts)
 
-    async def embed(self, text: str) -> List[float]:
-        """Legacy method for single text embedding"""
-        embeddings = await self.embed_batch([text])
-        return embeddings[0]
+            except RateLimitError as e:
+                if attempt == self.max_retries:
+                    logging.error(f"Voyage AI rate limit persisted after {self.max_retries} retries: {str(e)}")
+                    raise
+                delay = self._retry_delay(e, attempt)
+                logging.warning(f"Voyage AI rate limited, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
 
-    async def embed_many(self, texts: List[str]) -> List[List[float]]:
-        """Process a large number of texts in optimal batches"""
-        all_embeddings = []
-        for i in range(0, len(texts), self.batch_size):
-            batch = texts[i:i + self.batch_size]
-            batch_embeddings = await self.embed_batch(batch)
-            all_embeddings.extend(batch_embeddings)
-        return all_embeddings
+            except Exception as e:
+                logging.error(f"Error in {self.model_name} batch embedding generation: {str(e)}")
+                raise
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Single text embedding, batched with other concurrent callers"""
+        return await self.batcher.embed(text)
+
+    async def embed_many(self, texts: List[str]) -> np.ndarray:
+        """Process a large number of texts in optimal batches, several at a time"""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def embed_chunk(index: int, chunk: List[str]):
+            async with semaphore:
+                return index, await self.embed_batch(chunk)
+
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        parts = await asyncio.gather(*[embed_chunk(i, batch) for i, batch in enumerate(batches)])
+
+        # Reassemble in input order
+        parts.sort(key=lambda part: part[0])
+        if not parts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.concatenate([embeddings for _, embeddings in parts])
+
+class ResultStore:
+    """Append-only Parquet store of processed resumes, one complete file per flush"""
+    def __init__(self, directory: Path, flush_every: int = 100):
+        self.directory = directory
+        self.flush_every = flush_every
+        self.schema = pa.schema([
+            ("filename", pa.string()),
+            ("raw_text", pa.string()),
+            ("story", pa.string()),
+            ("personality", pa.string()),
+            ("processed_date", pa.string()),
+            ("embedding_model", pa.string()),
+            ("story_embedding", pa.list_(pa.float16())),
+            ("personality_embedding", pa.list_(pa.float16()))
+        ])
+        self.buffer: List[Dict[str, Any]] = []
+        self.pending: List[Callable[[], None]] = []
+
+    def append_row(self, row: Dict[str, Any], on_flush: Optional[Callable[[], None]] = None) -> None:
+        """Buffer a row, writing a file every flush_every rows; on_flush runs once the row is on disk"""
+        self.buffer.append(row)
+        if on_flush is not None:
+            self.pending.append(on_flush)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write buffered rows to a new Parquet file"""
+        if not self.buffer:
+            return
+
+        columns = {}
+        for field in self.schema:
+            values = [row.get(field.name) for row in self.buffer]
+            if field.name.endswith("_embedding"):
+                # Embeddings are stored at half precision
+                values = [None if v is None else np.asarray(v, dtype=np.float16) for v in values]
+            columns[field.name] = pa.array(values, type=field.type)
+
+        # Write under a temporary name so a crash never leaves a partial .parquet file
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        path = self.directory / f"results_{timestamp}.parquet"
+        tmp_path = path.with_suffix(".parquet.tmp")
+        pq.write_table(pa.table(columns, schema=self.schema), tmp_path)
+        tmp_path.replace(path)
+        self.buffer.clear()
+
+        callbacks, self.pending = self.pending, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"Error in result store flush callback: {str(e)}")
+
+    def close(self) -> None:
+        """Flush remaining rows"""
+        self.flush()
+
+    def read(self) -> Optional[pa.Table]:
+        """All stored rows across every readable file, or None if nothing has been stored"""
+        self.flush()
+        tables = []
+        for path in sorted(self.directory.glob("*.parquet")):
+            try:
+                tables.append(pq.read_table(path))
+            except Exception as e:
+                logging.error(f"Skipping unreadable result file {path}: {str(e)}")
+        if not tables:
+            return None
+        # Files written before a column was added are filled with nulls
+        return pa.concat_tables(tables, promote_options="default")
 
 class SemanticATS:
     """Main class for Semantic ATS processing"""
     def __init__(self):
         self.logger = setup_logging()
-        self.llm = LLMProcessor()
+
+        # Keep-alive HTTP/2 pool shared by all concurrent LLM calls
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=60,
+            limits=httpx.Limits(max_keepalive_connections=64, max_connections=128)
+        )
+        self.llm = LLMProcessor(http_client=self.http_client)
         self.embedding_model = EmbeddingModel()
+        self.collections = {
+            name: name + self.embedding_model.collection_suffix
+            for name in ["storyteller", "personality"]
+        }
+
+        # LLM outputs keyed by (resume content hash, task)
+        self.llm_cache = diskcache.Cache("data/llm_cache")
         
         # Setup Qdrant cloud client
-        self.qdrant = QdrantClient(
+        self.qdrant = AsyncQdrantClient(
             url=os.getenv('QDRANT_URL'),
-            api_key=os.getenv('QDRANT_API_KEY')
+            api_key=os.getenv('QDRANT_API_KEY'),
+            prefer_grpc=True
         )
         
-        # Create collections if they don't exist
-        self._initialize_collections()
-        
         # Setup directories
         self.dirs = {
             'data_input': Path('data/resumes'),
             'processed': Path('data/processed_resumes'),
             'errors': Path('data/errors'),
-            'results': Path('data/results'),
-            'storyteller': Path('data/results/storyteller'),
-            'personality': Path('data/results/personality')
+            'results': Path('data/results')
         }
         
         for dir_path in self.dirs.values():
             dir_path.mkdir(parents=True, exist_ok=True)
 
-    def _initialize_collections(self):
+        # Processed resumes and their embeddings, used to rebuild collections
+        self.results = ResultStore(self.dirs['results'])
+
+    async def initialize(self) -> None:
+        """Create collections if they don't exist"""
+        await self._initialize_collections()
+
+    async def close(self) -> None:
+        """Release pooled HTTP and Qdrant connections, the embedding worker and the LLM cache"""
+        await self.embedding_model.batcher.close()
+        await self.http_client.aclose()
+        await self.qdrant.close()
+        self.llm_cache.close()
+        self.results.close()
+
+    @staticmethod
+    def _quantization_config() -> models.ScalarQuantization:
+        """INT8 scalar quantization kept in RAM; full vectors are used for rescoring"""
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                quantile=0.99,
+                always_ram=True
+            )
+        )
+
+    async def _initialize_collections(self):
         """Initialize Qdrant collections for storyteller and personality"""
-        collections = ["storyteller", "personality"]
-        vector_size = 1024  # Voyage AI's default embedding size for voyage-3-large
+        collections = list(self.collections.values())
+        vector_size = self.embedding_model.dimension  # 1024 for both voyage-3 and bge-large
+
+        existing_collections = [c.name for c in (await self.qdrant.get_collections()).collections]
 
         for collection in collections:
             try:
                 # First, check if the collection exists
-                existing_collections = self.qdrant.get_collections().collections
-                if collection in [c.name for c in existing_collections]:
+                if collection in existing_collections:
                     self.logger.info(f"Collection already exists: {collection}")
                     continue
 
                 # If it doesn't exist, create it with explicit config
-                self.qdrant.create_collection(
+                await self.qdrant.create_collection(
                     collection_name=collection,
                     vectors_config=models.VectorParams(
                         size=vector_size,
-                        distance=models.Distance.COSINE
+                        distance=models.Distance.COSINE,
+                        datatype=models.Datatype.FLOAT16  # Full-precision copy used for rescoring, kept in RAM
+                    ),
+                    hnsw_config=models.HnswConfigDiff(
+                        m=32,
+                        ef_construct=256,
+                        on_disk=False  # Keep the graph resident for search
                     ),
                     optimizers_config=models.OptimizersConfigDiff(
-                        default_segment_number=2,
+                        default_segment_number=max(2, (os.cpu_count() or 4) // 2),
                         max_optimization_threads=2
-                    )
+                        # No memmap_threshold: large segments would move the rescoring vectors to disk
+                    ),
+                    on_disk_payload=True,  # Large raw_text payloads stay off the hot path
+                    quantization_config=self._quantization_config()
                 )
                 self.logger.info(f"Created collection: {collection}")
 
@@ -157,6 +450,18 @@ class SemanticATS:
                     self.logger.error("Validation error details: Check vector_size and optimizer configs")
                 raise
 
+        # Collections created before quantization (including Full_Texts) get migrated in place
+        for collection in collections + ["Full_Texts"]:
+            if collection not in existing_collections:
+                continue
+            info = await self.qdrant.get_collection(collection_name=collection)
+            if info.config.quantization_config is None:
+                await self.qdrant.update_collection(
+                    collection_name=collection,
+                    quantization_config=self._quantization_config()
+                )
+                self.logger.info(f"Enabled INT8 quantization on collection: {collection}")
+
     async def storyteller(self, text: str) -> str:
         """Transform resume into a coherent story"""
         prompt = """WEIRD ASK BUT PLEASE REWRITE THIS CANDIDATE'S RESUME AS A COHERENT STORY."""
@@ -168,64 +473,93 @@ class SemanticATS:
         READING BETWEEN THE LINES."""
         return await self.llm.process(text, prompt)
     
-    async def semantic_embedding(self, text: Union[str, List[str]]) -> Union[List[float], List[List[float]]]:
+    async def analyze(self, text: str) -> Tuple[str, str]:
+        """Story and personality for a resume, skipping the LLM for resumes seen before"""
+        content_hash = blake3.blake3(text.encode()).hexdigest()
+        story = self.llm_cache.get((content_hash, "story"))
+        personality = self.llm_cache.get((content_hash, "personality"))
+
+        # Only call the LLM for whichever analyses aren't cached
+        tasks = {}
+        if story is None:
+            tasks["story"] = self.storyteller(text)
+        if personality is None:
+            tasks["personality"] = self.extract_personality(text)
+
+        if tasks:
+            generated = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+            for task, output in generated.items():
+                self.llm_cache[(content_hash, task)] = output
+            story = generated.get("story", story)
+            personality = generated.get("personality", personality)
+        else:
+            self.logger.info("Reusing cached analyses for previously processed resume")
+
+        return story, personality
+
+    async def semantic_embedding(self, text: Union[str, List[str]]) -> np.ndarray:
         """Generate embeddings for text or list of texts"""
         if isinstance(text, str):
             return await self.embedding_model.embed(text)
         else:
             return await self.embedding_model.embed_many(text)
     
-    def reduced_embedding(self, embeddings: List[float], method: str = 'umap') -> List[float]:
+    def reduced_embedding(self, embeddings: np.ndarray, method: str = 'umap') -> np.ndarray:
         """Reduce embedding dimensions using specified method"""
         # For now, we'll return the original embeddings
         # TODO: Implement dimension reduction if needed
         return embeddings
     
-    async def database_upload(self, data: Union[Dict[str, Any], List[Dict[str, Any]]], destination: str) -> None:
-        """Upload data to Qdrant in batches"""
+    @staticmethod
+    def _point_id(item: Dict[str, Any], collection_name: str) -> str:
+        """Deterministic point id, so re-indexing a resume overwrites its point instead of duplicating it"""
+        content_hash = blake3.blake3(item['raw_text'].encode()).hexdigest()
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{collection_name}/{content_hash}"))
+
+    def _point_payload(self, item: Dict[str, Any], destination: str) -> Dict[str, Any]:
+        """Build the Qdrant payload stored alongside a resume embedding"""
+        metadata = {
+            'filename': item['filename'],
+            'raw_text': item['raw_text'],
+            'processed_date': item['processed_date']
+        }
+
+        # Add specific fields based on destination
+        if destination == 'storyteller_embeddings':
+            metadata['story'] = item['story']
+        elif destination == 'personality_embeddings':
+            metadata['personality'] = item['personality']
+
+        return metadata
+
+    async def database_upload(self, data: Union[Dict[str, Any], List[Dict[str, Any]]], destination: str,
+                              embeddings: Optional[np.ndarray] = None) -> None:
+        """Upload data to Qdrant in batches, taking vectors from `embeddings` rows or each item's 'embeddings'"""
         try:
             # If single data point, convert to list
             if isinstance(data, dict):
                 data = [data]
 
-            # Prepare batch points
-            points = []
-            collection_name = destination.split('_')[0]  # 'storyteller' or 'personality'
-
-            for item in data:
-                # Extract the embeddings from the data
-                embeddings = item.pop('embeddings')
-
-                # Prepare metadata
-                metadata = {
-                    'filename': item['filename'],
-                    'raw_text': item['raw_text'],
-                    'processed_date': item['processed_date']
-                }
-
-                # Add specific fields based on destination
-                if destination == 'storyteller_embeddings':
-                    metadata['story'] = item['story']
-                elif destination == 'personality_embeddings':
-                    metadata['personality'] = item['personality']
-
-                # Create point
-                points.append(
-                    models.PointStruct(
-                        id=uuid.uuid4().hex,
-                        vector=embeddings,
-                        payload=metadata
-                    )
-                )
-
-            BATCH_SIZE = 100
-            for i in range(0, len(points), BATCH_SIZE):
-                batch = points[i:i + BATCH_SIZE]
-                self.qdrant.upsert(
-                    collection_name=collection_name,
-                    points=batch
-                )
-                self.logger.info(f"Uploaded batch {i//BATCH_SIZE + 1} of {(len(points) + BATCH_SIZE - 1)//BATCH_SIZE} to {destination}")
+            collection_name = self.collections[destination.split('_')[0]]  # 'storyteller' or 'personality'
+
+            # Parallel ids / vectors / payloads rather than one PointStruct per item
+            ids = [self._point_id(item, collection_name) for item in data]
+            vectors = embeddings if embeddings is not None else np.stack([item['embeddings'] for item in data])
+            payloads = [self._point_payload(item, destination) for item in data]
+
+            # The uploader batches and parallelizes the requests itself; it is
+            # synchronous even on the async client, so keep it off the event loop
+            await asyncio.to_thread(
+                self.qdrant.upload_collection,
+                collection_name=collection_name,
+                ids=ids,
+                vectors=vectors,
+                payload=payloads,
+                batch_size=UPLOAD_BATCH_SIZE,
+                parallel=UPLOAD_PARALLEL,
+                wait=False
+            )
+            self.logger.info(f"Uploaded {len(ids)} points to {destination}")
                 
             # TODO: You need to add a thing where onc eit finishes the upload it pushes and shoves it into the finished file thingy 
 
@@ -234,171 +568,177 @@ class SemanticATS:
             raise
         
     
-    def save_as_json(self, data: Dict[str, Any], category: str) -> None:
-        """Save data as JSON file with proper serialization"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = self.dirs[category] / f"{data['filename']}_{timestamp}.json"
-
-        # Ensure all data is JSON serializable
-        serializable_data = {}
-        for key, value in data.items():
-            if isinstance(value, (str, int, float, bool, type(None))):
-                serializable_data[key] = value
-            else:
-                # Convert any complex objects to strings
-                serializable_data[key] = str(value)
-
-        with open(filename, 'w') as f:
-            json.dump(serializable_data, f, indent=2)
-
-        self.logger.info(f"Saved JSON file: {filename}")
-    
     async def process_file(self, filepath: Path) -> None:
         """Process a single resume file"""
         self.logger.info(f"Processing file: {filepath.name}")
         
         try:
             # Read the file
-            with open(filepath, 'r') as f:
-                text = f.read()
+            async with aiofiles.open(filepath, 'r') as f:
+                text = await f.read()
             
             self.logger.info(f"File {filepath.name} content preview: {text[:100]}...")
             
-            # Generate story and personality analysis
-            story = await self.storyteller(text)
-            self.logger.info(f"Generated story for {filepath.name}")
-            
-            personality = await self.extract_personality(text)
-            self.logger.info(f"Generated personality analysis for {filepath.name}")
+            # Generate story and personality analysis side by side
+            story, personality = await self.analyze(text)
+            self.logger.info(f"Generated story and personality analysis for {filepath.name}")
             
-            # Save results
-            base_data = {
+            # Save results; the file moves to processed/ once its row is safely on disk
+            self.results.append_row({
                 "filename": filepath.name,
                 "raw_text": text,
+                "story": story,
+                "personality": personality,
                 "processed_date": datetime.now().isoformat()
-            }
+            }, on_flush=lambda: filepath.rename(self.dirs['processed'] / filepath.name))
             
-            # Save storyteller version
-            story_data = {
-                **base_data,
+        except Exception as e:
+            self.logger.error(f"Error processing {filepath.name}: {str(e)}")
+            error_path = self.dirs['errors'] / filepath.name
+            filepath.rename(error_path)
+            raise
+    
+    async def process_and_index(self, filepath: Path) -> None:
+        """Analyze, embed, index and save a single resume file in one pass"""
+        self.logger.info(f"Processing file: {filepath.name}")
+
+        try:
+            # Read the file
+            async with aiofiles.open(filepath, 'r') as f:
+                text = await f.read()
+
+            # Generate story and personality analysis side by side
+            story, personality = await self.analyze(text)
+            self.logger.info(f"Generated story and personality analysis for {filepath.name}")
+
+            # Embeddings are coalesced with other files' into full Voyage batches
+            story_embedding, personality_embedding = await asyncio.gather(
+                self.embedding_model.embed(story),
+                self.embedding_model.embed(personality)
+            )
+
+            # One row feeds both point payloads and the result store
+            row = {
+                "filename": filepath.name,
+                "raw_text": text,
                 "story": story,
-                "type": "story"
-            }
-            self.save_as_json(story_data, 'storyteller')
-            
-            # Save personality version
-            personality_data = {
-                **base_data,
                 "personality": personality,
-                "type": "personality"
+                "processed_date": datetime.now().isoformat()
             }
-            self.save_as_json(personality_data, 'personality')
-            
-            # Move processed file
-            dest_path = self.dirs['processed'] / filepath.name
-            filepath.rename(dest_path)
-            
+
+            await asyncio.gather(
+                self.qdrant.upsert(
+                    collection_name=self.collections["storyteller"],
+                    points=[
+                        models.PointStruct(
+                            id=self._point_id(row, self.collections["storyteller"]),
+                            vector=self.reduced_embedding(story_embedding).tolist(),
+                            payload=self._point_payload(row, 'storyteller_embeddings')
+                        )
+                    ]
+                ),
+                self.qdrant.upsert(
+                    collection_name=self.collections["personality"],
+                    points=[
+                        models.PointStruct(
+                            id=self._point_id(row, self.collections["personality"]),
+                            vector=self.reduced_embedding(personality_embedding).tolist(),
+                            payload=self._point_payload(row, 'personality_embeddings')
+                        )
+                    ]
+                )
+            )
+            self.logger.info(f"Indexed {filepath.name}")
+
+            # Keep the results so collections can be rebuilt with process_storyteller/process_personality;
+            # the file moves to processed/ once its row is safely on disk
+            row["embedding_model"] = self.embedding_model.model_name
+            row["story_embedding"] = story_embedding
+            row["personality_embedding"] = personality_embedding
+            self.results.append_row(row, on_flush=lambda: filepath.rename(self.dirs['processed'] / filepath.name))
+
         except Exception as e:
             self.logger.error(f"Error processing {filepath.name}: {str(e)}")
             error_path = self.dirs['errors'] / filepath.name
             filepath.rename(error_path)
             raise
-    
-    async def process_storyteller(self) -> None:
-        """Process all storyteller JSON files in batches"""
-        # Collect all files and data first
-        all_data = []
-        texts_to_embed = []
 
-        # Read all files
-        for json_file in self.dirs['storyteller'].glob('*.json'):
-            try:
-                with open(json_file, 'r') as f:
-                    data = json.load(f)
-                    all_data.append(data)
-                    texts_to_embed.append(data['story'])
-            except json.JSONDecodeError as e:
-                print(f"Error parsing JSON file: {json_file}")
-                print(f"Error message: {e}")
-
-        if not texts_to_embed:
-            self.logger.info("No storyteller files to process")
-            return
+    async def _stored_embeddings(self, table: pa.Table, text_column: str, embedding_column: str) -> np.ndarray:
+        """Embeddings saved with each row, regenerating those missing or made by another model"""
+        stored = table[embedding_column].to_numpy(zero_copy_only=False)
+        if "embedding_model" in table.column_names:
+            models_used = table["embedding_model"].to_pylist()
+        else:
+            models_used = [None] * len(stored)
+        embeddings = np.empty((len(stored), self.embedding_model.dimension), dtype=np.float32)
 
-        # Process embeddings in chunks of 128
-        EMBED_CHUNK_SIZE = 128
-        all_embeddings = []
+        missing = [
+            i for i, (embedding, model_name) in enumerate(zip(stored, models_used))
+            if embedding is None or model_name != self.embedding_model.model_name
+        ]
+        if missing:
+            texts = table[text_column].to_pylist()
+            embeddings[missing] = await self.semantic_embedding([texts[i] for i in missing])
+            self.logger.info(f"Generated {len(missing)} {text_column} embeddings")
+
+        reuse = set(range(len(stored))) - set(missing)
+        for i in reuse:
+            embeddings[i] = stored[i]
+        return embeddings
 
-        for i in range(0, len(texts_to_embed), EMBED_CHUNK_SIZE):
-            chunk_texts = texts_to_embed[i:i + EMBED_CHUNK_SIZE]
-            chunk_embeddings = await self.semantic_embedding(chunk_texts)
-            all_embeddings.extend(chunk_embeddings)
-            self.logger.info(f"Processed embedding chunk {i//EMBED_CHUNK_SIZE + 1} of {(len(texts_to_embed) + EMBED_CHUNK_SIZE - 1)//EMBED_CHUNK_SIZE}")
+    async def process_storyteller(self) -> None:
+        """Re-index all stored stories in batches"""
+        table = self.results.read()
+        if table is None or table.num_rows == 0:
+            self.logger.info("No storyteller results to process")
+            return
 
-        # Prepare all data for upload
-        upload_batch = []
-        for data, embedding in zip(all_data, all_embeddings):
-            reduced = self.reduced_embedding(embedding)
-            data['embeddings'] = reduced
-            upload_batch.append(data)
+        all_data = table.select(['filename', 'raw_text', 'processed_date', 'story']).to_pylist()
+        all_embeddings = await self._stored_embeddings(table, 'story', 'story_embedding')
 
         # Upload all data in one batch operation
-        await self.database_upload(upload_batch, 'storyteller_embeddings')
+        await self.database_upload(all_data, 'storyteller_embeddings', embeddings=self.reduced_embedding(all_embeddings))
 
     async def process_personality(self) -> None:
-        """Process all personality JSON files in batches"""
-        # Collect all files and data first
-        all_data = []
-        texts_to_embed = []
-
-        # Read all files
-        for json_file in self.dirs['personality'].glob('*.json'):
-            try:
-                with open(json_file, 'r') as f:
-                    data = json.load(f)
-                    all_data.append(data)
-                    texts_to_embed.append(data['personality'])
-            except json.JSONDecodeError as e:
-                print(f"Error parsing JSON file: {json_file}")
-                print(f"Error message: {e}")
-        
-        if not texts_to_embed:
-            self.logger.info("No personality files to process")
+        """Re-index all stored personality analyses in batches"""
+        table = self.results.read()
+        if table is None or table.num_rows == 0:
+            self.logger.info("No personality results to process")
             return
 
-        # Process in chunks of 128
-        CHUNK_SIZE = 128
-        all_embeddings = []
-
-        for i in range(0, len(texts_to_embed), CHUNK_SIZE):
-            chunk_texts = texts_to_embed[i:i + CHUNK_SIZE]
-            chunk_embeddings = await self.semantic_embedding(chunk_texts)
-            all_embeddings.extend(chunk_embeddings)
-            self.logger.info(f"Processed chunk {i//CHUNK_SIZE + 1} of {(len(texts_to_embed) + CHUNK_SIZE - 1)//CHUNK_SIZE}")
-
-        # Prepare all data for upload
-        upload_batch = []
-        for data, embedding in zip(all_data, all_embeddings):
-            reduced = self.reduced_embedding(embedding)
-            data['embeddings'] = reduced
-            upload_batch.append(data)
-        
+        all_data = table.select(['filename', 'raw_text', 'processed_date', 'personality']).to_pylist()
+        all_embeddings = await self._stored_embeddings(table, 'personality', 'personality_embedding')
+
         # Upload all data in one batch operation
-        await self.database_upload(upload_batch, 'personality_embeddings')
+        await self.database_upload(all_data, 'personality_embeddings', embeddings=self.reduced_embedding(all_embeddings))
 
 async def main():
     """Main execution function"""
     ats = SemanticATS()
+    await ats.initialize()
     
     # Process all resume files
     resume_files = list(ats.dirs['data_input'].glob('*.txt'))
     
-    # Process files concurrently
-    await asyncio.gather(*[ats.process_file(file) for file in resume_files])
-    
-    # Process embeddings
-    await ats.process_storyteller()
-    await ats.process_personality()
+    # Process files concurrently, bounded to respect Anthropic rate limits
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+
+    async def process_bounded(file: Path) -> None:
+        async with semaphore:
+            await ats.process_and_index(file)
+
+    try:
+        # Let every file settle before closing the shared clients
+        results = await asyncio.gather(
+            *[process_bounded(file) for file in resume_files],
+            return_exceptions=True
+        )
+        failures = [(file, result) for file, result in zip(resume_files, results) if isinstance(result, Exception)]
+        for file, error in failures:
+            ats.logger.error(f"Failed to process {file.name}: {str(error)}")
+        ats.logger.info(f"Processed {len(resume_files) - len(failures)} of {len(resume_files)} files")
+    finally:
+        await ats.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file